@@ -1,9 +1,19 @@
+import time
+
+# Startup phase marks: (phase name, perf_counter when it finished)
+STARTUP_PHASES = [("start", time.perf_counter())]
+
 import logging
 import json
 import os
+import bisect
+import asyncio
+import uuid
 import datetime
 import pytz
+from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -14,6 +24,8 @@ from telegram.ext import (
     filters,
 )
 
+STARTUP_PHASES.append(("imports", time.perf_counter()))
+
 # ---------------------- Configuration and Global Variables ---------------------- #
 
 # Enable logging
@@ -33,12 +45,50 @@ NAME_CHANGE = 200
 ADMIN_BALANCE_SELECT_USER, ADMIN_BALANCE_ENTER_AMOUNT = range(100, 102)
 # Conversation states for admin daily price adjustment (set user's daily price)
 ADMIN_DAILY_PRICE_SELECT_USER, ADMIN_DAILY_PRICE_ENTER_AMOUNT = range(102, 104)
+# Conversation state for admin menu setup (dishes of a given date)
+ADMIN_MENU_ENTER_DISHES = 104
 
-# File paths
-DATA_FILE = "data.json"
-ADMIN_FILE = "admins.json"
+# Settings are read from .env (if present) and the environment
+load_dotenv()
+BOT_TOKEN = os.getenv("BOT_TOKEN")
 
-# Global lunch menu options mapping (menu option number -> dish name)
+# File paths
+DATA_FILE = os.getenv("DATA_FILE", "data.json")
+ADMIN_FILE = os.getenv("ADMIN_FILE", "admins.json")
+TENANTS_FILE = os.getenv("TENANTS_FILE", "tenants.json")
+OUTBOX_FILE = os.getenv("OUTBOX_FILE", "outbox.json")
+
+# Daily job hours (Tashkent time)
+SURVEY_HOUR = int(os.getenv("SURVEY_HOUR", "7"))
+SUMMARY_HOUR = int(os.getenv("SUMMARY_HOUR", "10"))
+FORECAST_HOUR = int(os.getenv("FORECAST_HOUR", "18"))
+
+# Smoothing factor of the per-weekday demand forecast (higher reacts faster to recent days)
+FORECAST_ALPHA = float(os.getenv("FORECAST_ALPHA", "0.3"))
+
+# Seconds to wait before writing data.json after a button tap, so a burst of taps costs one write
+SAVE_DELAY = 1.0
+# Repeated taps on the same button of the same message within this many seconds are ignored
+TAP_WINDOW = 2.0
+
+# Outbound message retries: delay doubles after each failed attempt, up to OUTBOX_MAX_DELAY
+OUTBOX_BASE_DELAY = 30
+OUTBOX_MAX_DELAY = 3600
+OUTBOX_MAX_ATTEMPTS = 8
+# How often the outbox is retried, and how long delivered keys are remembered for deduplication (seconds)
+OUTBOX_INTERVAL = 30
+OUTBOX_KEY_TTL = 2 * 24 * 3600
+
+# Tenant (office/canteen) used when tenants.json is missing or a user has no tenant assigned
+DEFAULT_TENANT = "default"
+
+# Daily price charged when neither the user nor the tenant sets one
+DEFAULT_DAILY_PRICE = 25000
+
+# Users are warned when their balance drops below this (unless they or their tenant set another limit)
+LOW_BALANCE_THRESHOLD = int(os.getenv("LOW_BALANCE_THRESHOLD", "100000"))
+
+# Default lunch menu options mapping (menu option number -> dish name); tenants may override it
 MENU_OPTIONS = {
     "1": "Qovurma Lag'mon",
     "2": "Teftel Jarkob",
@@ -53,11 +103,71 @@ MENU_OPTIONS = {
     "11": "Xonim"
 }
 
+STARTUP_PHASES.append(("config", time.perf_counter()))
+
+# ---------------------- Tenants ---------------------- #
+
+# tenants.json holds the settings of each office/canteen and the user -> tenant map:
+# {"tenants": {"<id>": {"data_file": ..., "admin_file": ..., "survey_hour": ..., "menu": {...},
+#                        "low_balance_threshold": ...}},
+#  "users": {"<user id>": "<tenant id>"}}
+tenants_cache = None
+
+def initialize_tenants():
+    global tenants_cache
+    if tenants_cache is not None:
+        return tenants_cache
+    if os.path.exists(TENANTS_FILE):
+        with open(TENANTS_FILE, "r", encoding="utf-8") as f:
+            tenants = json.load(f)
+    else:
+        tenants = {"tenants": {DEFAULT_TENANT: {}}, "users": {}}
+    tenants.setdefault("tenants", {}).setdefault(DEFAULT_TENANT, {})
+    tenants.setdefault("users", {})
+    tenants_cache = tenants
+    return tenants
+
+def save_tenants(tenants):
+    with open(TENANTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(tenants, f, ensure_ascii=False, indent=4)
+
+def tenant_of(user_id):
+    return initialize_tenants()["users"].get(str(user_id), DEFAULT_TENANT)
+
+def assign_tenant(user_id, tenant):
+    tenants = initialize_tenants()
+    if tenants["users"].get(str(user_id)) != tenant:
+        tenants["users"][str(user_id)] = tenant
+        save_tenants(tenants)
+
+def tenant_setting(tenant, key, default=None):
+    return initialize_tenants()["tenants"].get(tenant, {}).get(key, default)
+
+def tenant_data_file(tenant):
+    default = DATA_FILE if tenant == DEFAULT_TENANT else f"data_{tenant}.json"
+    return tenant_setting(tenant, "data_file", default)
+
+def tenant_admin_file(tenant):
+    default = ADMIN_FILE if tenant == DEFAULT_TENANT else f"admins_{tenant}.json"
+    return tenant_setting(tenant, "admin_file", default)
+
+def tenant_menu(tenant):
+    return tenant_setting(tenant, "menu", MENU_OPTIONS)
+
+def daily_price(tenant, info):
+    return info.get("daily_price", tenant_setting(tenant, "daily_price", DEFAULT_DAILY_PRICE))
+
 # ---------------------- Data and Admin Initialization ---------------------- #
 
-def initialize_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
+# Each tenant's data file is loaded on first use and then kept in memory; save_data writes it back
+data_caches = {}
+
+def initialize_data(tenant=DEFAULT_TENANT):
+    if tenant in data_caches:
+        return data_caches[tenant]
+    data_file = tenant_data_file(tenant)
+    if os.path.exists(data_file):
+        with open(data_file, "r", encoding="utf-8") as f:
             data = json.load(f)
     else:
         data = {
@@ -67,31 +177,475 @@ def initialize_data():
         }
     if "kassa" not in data:
         data["kassa"] = 0
+    data_caches[tenant] = data
     return data
 
-def initialize_admins():
-    if os.path.exists(ADMIN_FILE):
-        with open(ADMIN_FILE, "r", encoding="utf-8") as f:
+def initialize_admins(tenant=DEFAULT_TENANT):
+    admin_file = tenant_admin_file(tenant)
+    if os.path.exists(admin_file):
+        with open(admin_file, "r", encoding="utf-8") as f:
             return json.load(f)
     else:
         return {"admins": []}
 
-def save_data(data):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
+def save_data(data, tenant=DEFAULT_TENANT):
+    with open(tenant_data_file(tenant), "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=4)
 
-def save_admins(admins):
-    with open(ADMIN_FILE, "w", encoding="utf-8") as f:
+# Deferred save for hot paths: a tenant's data is written once SAVE_DELAY after its first change
+save_tasks = {}
+
+def save_data_later(tenant=DEFAULT_TENANT):
+    task = save_tasks.get(tenant)
+    if task is None or task.done():
+        save_tasks[tenant] = asyncio.get_running_loop().create_task(flush_data_later(tenant))
+
+async def flush_data_later(tenant):
+    await asyncio.sleep(SAVE_DELAY)
+    save_data(data_caches[tenant], tenant)
+
+def flush_pending_saves():
+    for tenant, task in save_tasks.items():
+        if not task.done():
+            task.cancel()
+            save_data(data_caches[tenant], tenant)
+
+def save_admins(admins, tenant=DEFAULT_TENANT):
+    with open(tenant_admin_file(tenant), "w", encoding="utf-8") as f:
         json.dump(admins, f)
 
 def is_admin(user_id, admins):
     return str(user_id) in admins["admins"]
 
+# ---------------------- Outbound Messages ---------------------- #
+
+# Messages are written to outbox.json before sending, so failed sends survive restarts and are retried:
+# {"messages": [{"key": ..., "chat_id": ..., "text": ..., "reply_markup": {...}, "attempts": n, "next_attempt": ts}],
+#  "dead_letters": [...], "dead_chats": {"<chat id>": "<error>"}, "sent_keys": {"<key>": ts}}
+outbox_cache = None
+# Keys being sent right now, so concurrent flushes never send the same message twice
+sending_keys = set()
+# Keys of messages still waiting in the queue, for O(1) de-duplication
+queued_keys = set()
+
+def initialize_outbox():
+    global outbox_cache
+    if outbox_cache is not None:
+        return outbox_cache
+    if os.path.exists(OUTBOX_FILE):
+        with open(OUTBOX_FILE, "r", encoding="utf-8") as f:
+            outbox = json.load(f)
+    else:
+        outbox = {}
+    for key, default in (("messages", []), ("dead_letters", []), ("dead_chats", {}), ("sent_keys", {})):
+        outbox.setdefault(key, default)
+    queued_keys.update(msg["key"] for msg in outbox["messages"])
+    outbox_cache = outbox
+    return outbox
+
+def save_outbox(outbox):
+    with open(OUTBOX_FILE, "w", encoding="utf-8") as f:
+        json.dump(outbox, f, ensure_ascii=False, indent=4)
+
+# Chats that blocked the bot or no longer exist; broadcasts skip them
+def is_dead_chat(chat_id):
+    return str(chat_id) in initialize_outbox()["dead_chats"]
+
+def revive_chat(chat_id):
+    outbox = initialize_outbox()
+    if outbox["dead_chats"].pop(str(chat_id), None) is not None:
+        save_outbox(outbox)
+
+# Queue (chat_id, text, reply_markup, key) tuples and write the outbox once; returns one key
+# per message, or None where the chat is dead or the key was already queued or sent
+def enqueue_messages(messages):
+    outbox = initialize_outbox()
+    keys = []
+    for chat_id, text, reply_markup, key in messages:
+        if is_dead_chat(chat_id):
+            keys.append(None)
+            continue
+        if key is None:
+            key = uuid.uuid4().hex
+        elif key in outbox["sent_keys"] or key in queued_keys:
+            keys.append(None)
+            continue
+        outbox["messages"].append({
+            "key": key,
+            "chat_id": str(chat_id),
+            "text": text,
+            "reply_markup": reply_markup.to_dict() if reply_markup else None,
+            "attempts": 0,
+            "next_attempt": 0
+        })
+        queued_keys.add(key)
+        keys.append(key)
+    if any(keys):
+        save_outbox(outbox)
+    return keys
+
+def enqueue_message(chat_id, text, reply_markup=None, key=None):
+    return enqueue_messages([(chat_id, text, reply_markup, key)])[0]
+
+def dead_letter(outbox, msg, error):
+    msg["error"] = str(error)
+    outbox["dead_letters"].append(msg)
+    logger.error(f"Giving up on message {msg['key']} to chat {msg['chat_id']}: {error}")
+
+# Send the due queued messages with the given keys (all of them when keys is None);
+# returns the keys delivered in this run. Failures stay queued for process_outbox.
+async def flush_outbox(bot, keys=None):
+    outbox = initialize_outbox()
+    now = time.time()
+    if keys is not None:
+        keys = set(keys)
+    # Messages another flush is already sending are left to it
+    batch = [msg for msg in outbox["messages"]
+             if msg["next_attempt"] <= now and msg["key"] not in sending_keys and (keys is None or msg["key"] in keys)]
+    if not batch:
+        return set()
+    sending_keys.update(msg["key"] for msg in batch)
+    delivered = set()
+    finished = set()
+    try:
+        for msg in batch:
+            if is_dead_chat(msg["chat_id"]):
+                dead_letter(outbox, msg, "chat is marked dead")
+                finished.add(msg["key"])
+                continue
+            try:
+                reply_markup = InlineKeyboardMarkup.de_json(msg["reply_markup"], bot) if msg["reply_markup"] else None
+                await bot.send_message(chat_id=msg["chat_id"], text=msg["text"], reply_markup=reply_markup)
+                outbox["sent_keys"][msg["key"]] = time.time()
+                delivered.add(msg["key"])
+                finished.add(msg["key"])
+            except Forbidden as e:
+                # The user blocked the bot or the account is gone: stop writing to this chat
+                outbox["dead_chats"][msg["chat_id"]] = str(e)
+                dead_letter(outbox, msg, e)
+                finished.add(msg["key"])
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    outbox["dead_chats"][msg["chat_id"]] = str(e)
+                dead_letter(outbox, msg, e)
+                finished.add(msg["key"])
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else e.retry_after
+                msg["next_attempt"] = time.time() + retry_after
+            except Exception as e:
+                msg["attempts"] += 1
+                if msg["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                    dead_letter(outbox, msg, e)
+                    finished.add(msg["key"])
+                    continue
+                msg["next_attempt"] = time.time() + min(OUTBOX_BASE_DELAY * 2 ** (msg["attempts"] - 1), OUTBOX_MAX_DELAY)
+                logger.error(f"Failed to send message {msg['key']} to chat {msg['chat_id']} (attempt {msg['attempts']}): {e}")
+    finally:
+        sending_keys.difference_update(msg["key"] for msg in batch)
+        # Other flushes may have queued or finished messages while this one was sending
+        outbox["messages"] = [msg for msg in outbox["messages"] if msg["key"] not in finished]
+        queued_keys.difference_update(finished)
+        outbox["dead_letters"] = outbox["dead_letters"][-500:]
+        outbox["sent_keys"] = {key: at for key, at in outbox["sent_keys"].items() if now - at < OUTBOX_KEY_TTL}
+        save_outbox(outbox)
+    return delivered
+
+# Repeating job: retry queued messages whose backoff has passed
+async def process_outbox(context: ContextTypes.DEFAULT_TYPE):
+    if initialize_outbox()["messages"]:
+        await flush_outbox(context.bot)
+
+# ---------------------- User Lookup Indexes ---------------------- #
+
+# Secondary indexes so admin commands can find a user by phone or name without
+# scanning data["users"], kept per tenant: PHONE_INDEX[tenant] maps normalized
+# phone -> user ID, NAME_INDEX[tenant] is a sorted list of (name token, user ID)
+# pairs searched by prefix with bisect. A tenant is indexed on first use.
+PHONE_INDEX = {}
+NAME_INDEX = {}
+
+def normalize_phone(phone):
+    digits = "".join(ch for ch in str(phone) if ch.isdigit())
+    # Local numbers without the country code (e.g. 95 685 03 63)
+    if len(digits) == 9:
+        digits = "998" + digits
+    return digits
+
+def name_tokens(full_name):
+    return set(full_name.lower().split())
+
+def index_user(tenant, uid, info):
+    phone = normalize_phone(info.get("phone", ""))
+    if phone:
+        PHONE_INDEX[tenant][phone] = uid
+    for token in name_tokens(info.get("name", "")):
+        bisect.insort(NAME_INDEX[tenant], (token, uid))
+
+def unindex_user(tenant, uid, info):
+    phones = PHONE_INDEX[tenant]
+    names = NAME_INDEX[tenant]
+    phone = normalize_phone(info.get("phone", ""))
+    if phones.get(phone) == uid:
+        del phones[phone]
+    for token in name_tokens(info.get("name", "")):
+        pos = bisect.bisect_left(names, (token, uid))
+        if pos < len(names) and names[pos] == (token, uid):
+            del names[pos]
+
+def ensure_user_indexes(data, tenant):
+    if tenant in PHONE_INDEX:
+        return
+    phones = {}
+    names = []
+    for uid, info in data["users"].items():
+        phone = normalize_phone(info.get("phone", ""))
+        if phone:
+            phones[phone] = uid
+        names.extend((token, uid) for token in name_tokens(info.get("name", "")))
+    names.sort()
+    PHONE_INDEX[tenant] = phones
+    NAME_INDEX[tenant] = names
+
+def find_users(query, data, tenant):
+    ensure_user_indexes(data, tenant)
+    names = NAME_INDEX[tenant]
+    query = query.strip()
+    if query in data["users"]:
+        return [query]
+    uid = PHONE_INDEX[tenant].get(normalize_phone(query))
+    if uid in data["users"]:
+        return [uid]
+    # Every word of the query must be a prefix of one of the user's name tokens
+    matches = None
+    for token in query.lower().split():
+        found = set()
+        pos = bisect.bisect_left(names, (token, ""))
+        while pos < len(names) and names[pos][0].startswith(token):
+            found.add(names[pos][1])
+            pos += 1
+        matches = found if matches is None else matches & found
+    return sorted(uid for uid in matches or () if uid in data["users"])
+
+# Resolve an admin command argument (ID, phone number or part of a name) to a single user ID
+async def resolve_user_arg(update: Update, context: ContextTypes.DEFAULT_TYPE, data, tenant, query=None):
+    matches = find_users(query if query is not None else " ".join(context.args), data, tenant)
+    if not matches:
+        await update.message.reply_text("Bu foydalanuvchi topilmadi.")
+        return None
+    if len(matches) > 1:
+        msg = "Bir nechta foydalanuvchi topildi, aniqroq kiriting:\n\n"
+        for user_id in matches[:10]:
+            info = data["users"][user_id]
+            msg += f"ID: {user_id}, Ism: {info['name']}, Telefon: {info['phone']}\n"
+        await update.message.reply_text(msg)
+        return None
+    return matches[0]
+
+# ---------------------- Daily Menu ---------------------- #
+
+# Menus are stored per tenant in data["menus"]:
+# {"versions": {"<n>": {"dishes": {"<key>": {"name": ..., "price": ..., "limit": ...}}, "created": ...}},
+#  "dates": {"YYYY-MM-DD": "<n>"}}
+# A saved version never changes, so its dish table and keyboards are cached.
+# Dates without a version use the tenant's default menu (MENU_OPTIONS).
+menu_cache = {}
+keyboard_cache = {}
+
+def menu_version(data, date):
+    return data.get("menus", {}).get("dates", {}).get(date)
+
+# Callback form of a date's version; "0" is the default menu
+def menu_tag(data, date):
+    return menu_version(data, date) or "0"
+
+# Dish keys are positions in a version, so a date's menu cannot change once
+# someone has chosen from it or the day has been settled
+def menu_locked(data, date):
+    return bool(data["daily_attendance"].get(date, {}).get("menu")) or date in data["attendance_history"]
+
+def menu_dishes(tenant, data, version):
+    key = (tenant, version)
+    if key not in menu_cache:
+        if version is None:
+            menu_cache[key] = {dish: {"name": name} for dish, name in tenant_menu(tenant).items()}
+        else:
+            menu_cache[key] = data["menus"]["versions"][version]["dishes"]
+    return menu_cache[key]
+
+def date_menu(tenant, data, date):
+    return menu_dishes(tenant, data, menu_version(data, date))
+
+def dish_name(tenant, data, date, dish):
+    return date_menu(tenant, data, date).get(dish, {}).get("name", "N/A")
+
+# Menu options two per row: "1. Qovurma Lag'mon", "2. Teftel Jarkob", ...; sold-out dishes are marked
+def menu_keyboard(tenant, data, date):
+    sold_out = sold_out_dishes(tenant, data, date)
+    key = (tenant, menu_version(data, date), date, sold_out)
+    if key not in keyboard_cache:
+        if len(keyboard_cache) > 500:
+            keyboard_cache.clear()
+        buttons = [InlineKeyboardButton(f"🚫 {dish}. {info['name']} (tugadi)" if dish in sold_out else f"{dish}. {info['name']}",
+                                        callback_data=f"menu_{dish}_{date}_{menu_tag(data, date)}")
+                   for dish, info in date_menu(tenant, data, date).items()]
+        keyboard_cache[key] = InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+    return keyboard_cache[key]
+
+# One dish per line: "Name; price; portion limit" (price and limit are optional)
+def parse_menu_text(text):
+    dishes = {}
+    for line in text.splitlines():
+        parts = [part.strip() for part in line.split(";")]
+        if not parts[0]:
+            continue
+        dish = {"name": parts[0]}
+        if len(parts) > 1 and parts[1]:
+            dish["price"] = int(parts[1].replace(" ", "").replace(",", ""))
+        if len(parts) > 2 and parts[2]:
+            dish["limit"] = int(parts[2])
+        if dish.get("price", 0) < 0 or dish.get("limit", 0) < 0:
+            raise ValueError("negative price or limit")
+        dishes[str(len(dishes) + 1)] = dish
+    if not dishes:
+        raise ValueError("empty menu")
+    return dishes
+
+# Store a menu as a new version (or reuse an identical one) and return its version ID
+def save_menu_version(data, dishes):
+    menus = data.setdefault("menus", {"versions": {}, "dates": {}})
+    for version, rec in menus["versions"].items():
+        if rec["dishes"] == dishes:
+            return version
+    version = str(len(menus["versions"]) + 1)
+    menus["versions"][version] = {
+        "dishes": dishes,
+        "created": datetime.datetime.now(TASHKENT_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    }
+    return version
+
+def format_menu(dishes):
+    msg = ""
+    for dish, info in dishes.items():
+        msg += f"{dish}. {info['name']}"
+        if "price" in info:
+            msg += f" - {info['price']:,} so'm"
+        if "limit" in info:
+            msg += f" ({info['limit']} porsiya)"
+        msg += "\n"
+    return msg
+
+# ---------------------- Portion Limits ---------------------- #
+
+# Reserved portions per (tenant, date): {dish: count}, built from the date's choices on first use.
+# Reservations and releases never await, so concurrent handlers on the event loop cannot oversubscribe a dish.
+portion_counts = {}
+# Survey messages currently showing a date's menu keyboard: (tenant, date) -> {(chat ID, message ID)}
+open_menus = {}
+refresh_tasks = {}
+refresh_again = set()
+
+def dish_counts(tenant, data, date):
+    key = (tenant, date)
+    if key not in portion_counts:
+        attendance = data["daily_attendance"].get(date, {})
+        confirmed = set(attendance.get("confirmed", []))
+        counts = {}
+        for uid, dish in attendance.get("menu", {}).items():
+            if uid in confirmed:
+                counts[dish] = counts.get(dish, 0) + 1
+        portion_counts[key] = counts
+    return portion_counts[key]
+
+def sold_out_dishes(tenant, data, date):
+    counts = dish_counts(tenant, data, date)
+    return frozenset(dish for dish, info in date_menu(tenant, data, date).items()
+                     if "limit" in info and counts.get(dish, 0) >= info["limit"])
+
+# Reserve a portion and record the user's choice; returns False if the dish is sold out
+def reserve_portion(tenant, data, date, uid, dish):
+    attendance = data["daily_attendance"].setdefault(date, {"confirmed": [], "declined": [], "pending": [], "menu": {}})
+    counts = dish_counts(tenant, data, date)
+    choices = attendance.setdefault("menu", {})
+    previous = choices.get(uid) if uid in attendance["confirmed"] else None
+    if previous != dish:
+        limit = date_menu(tenant, data, date).get(dish, {}).get("limit")
+        if limit is not None and counts.get(dish, 0) >= limit:
+            return False
+        counts[dish] = counts.get(dish, 0) + 1
+        if previous is not None:
+            counts[previous] -= 1
+    choices[uid] = dish
+    if uid not in attendance["confirmed"]:
+        attendance["confirmed"].append(uid)
+    return True
+
+# Drop the user's dish choice for the date; call before removing them from "confirmed"
+def release_portion(tenant, data, date, uid):
+    attendance = data["daily_attendance"].get(date)
+    if not attendance:
+        return
+    counts = dish_counts(tenant, data, date)
+    dish = attendance.get("menu", {}).pop(uid, None)
+    if dish is not None and uid in attendance["confirmed"]:
+        counts[dish] -= 1
+
+# Counts are rebuilt from the choices on next use, e.g. after the date's menu version changes
+def reset_portion_counts(tenant, date):
+    portion_counts.pop((tenant, date), None)
+
+def forget_portions(tenant, date):
+    reset_portion_counts(tenant, date)
+    open_menus.pop((tenant, date), None)
+
+def track_open_menu(tenant, date, message):
+    if message:
+        open_menus.setdefault((tenant, date), set()).add((message.chat_id, message.message_id))
+
+def untrack_open_menu(tenant, date, message):
+    if message:
+        open_menus.get((tenant, date), set()).discard((message.chat_id, message.message_id))
+
+# Re-render open menu keyboards in the background when a dish sells out or becomes available again
+def refresh_open_menus_later(context: ContextTypes.DEFAULT_TYPE, tenant, date):
+    key = (tenant, date)
+    task = refresh_tasks.get(key)
+    if task is not None and not task.done():
+        refresh_again.add(key)
+        return
+    refresh_tasks[key] = context.application.create_task(refresh_open_menus(context.bot, tenant, date))
+
+async def refresh_open_menus(bot, tenant, date):
+    key = (tenant, date)
+    while True:
+        refresh_again.discard(key)
+        data = initialize_data(tenant)
+        keyboard = menu_keyboard(tenant, data, date)
+        for chat_id, message_id in list(open_menus.get(key, ())):
+            # The user may have picked a dish while we were waiting out flood control
+            while (chat_id, message_id) in open_menus.get(key, ()):
+                try:
+                    await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=keyboard)
+                except RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else e.retry_after
+                    await asyncio.sleep(retry_after)
+                    continue
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        open_menus.get(key, set()).discard((chat_id, message_id))
+                except Exception as e:
+                    logger.error(f"Failed to refresh menu for chat {chat_id}: {e}")
+                break
+        if key not in refresh_again:
+            return
+
 # ---------------------- Registration and Name Change ---------------------- #
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = str(update.effective_user.id)
-    data = initialize_data()
+    # A user who writes to the bot again can receive messages again
+    revive_chat(user_id)
+    tenant = tenant_of(user_id)
+    data = initialize_data(tenant)
     if user_id in data["users"]:
         user_name = data["users"][user_id]["name"].split()[0]
         await update.message.reply_text(
@@ -106,6 +660,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             ),
         )
         return ConversationHandler.END
+    # New users join an office through a deep link: /start <tenant id>
+    if context.args and context.args[0] in initialize_tenants()["tenants"]:
+        context.user_data["tenant"] = context.args[0]
     await update.message.reply_text(
         "Salom! My Tushlik botiga xush kelibsiz. Ro'yxatdan o'tish uchun telefon raqamingizni yuboring.",
         reply_markup=ReplyKeyboardMarkup(
@@ -129,18 +686,25 @@ async def phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     full_name = update.message.text
     user_id = str(update.effective_user.id)
-    data = initialize_data()
+    tenant = context.user_data.get("tenant", tenant_of(user_id))
+    assign_tenant(user_id, tenant)
+    data = initialize_data(tenant)
+    ensure_user_indexes(data, tenant)
+    if user_id in data["users"]:
+        unindex_user(tenant, user_id, data["users"][user_id])
     data["users"][user_id] = {
         "name": full_name,
         "phone": context.user_data["phone"],
         "balance": 0,
         "registration_date": datetime.datetime.now(TASHKENT_TZ).strftime("%Y-%m-%d %H:%M:%S")
     }
-    save_data(data)
-    admins = initialize_admins()
+    index_user(tenant, user_id, data["users"][user_id])
+    check_low_balance(tenant, data, user_id, notify=False)
+    save_data(data, tenant)
+    admins = initialize_admins(tenant)
     if not admins["admins"]:
         admins["admins"].append(user_id)
-        save_admins(admins)
+        save_admins(admins, tenant)
     await update.message.reply_text(
         f"Ro'yxatdan o'tdingiz, {full_name}!\n\nQuyidagi imkoniyatlardan foydalanishingiz mumkin:",
         reply_markup=ReplyKeyboardMarkup(
@@ -162,26 +726,61 @@ async def start_name_change(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def process_name_change(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     new_name = update.message.text
     uid = str(update.effective_user.id)
-    data = initialize_data()
+    tenant = tenant_of(uid)
+    data = initialize_data(tenant)
     if uid not in data["users"]:
         await update.message.reply_text("Iltimos, /start orqali ro'yxatdan o'ting.")
         return ConversationHandler.END
     old_name = data["users"][uid]["name"]
+    ensure_user_indexes(data, tenant)
+    unindex_user(tenant, uid, data["users"][uid])
     data["users"][uid]["name"] = new_name
-    save_data(data)
+    index_user(tenant, uid, data["users"][uid])
+    save_data(data, tenant)
     await update.message.reply_text(f"Sizning ismingiz {old_name} dan {new_name} ga o'zgartirildi.")
     return ConversationHandler.END
 
+# ---------------------- Callback Responses ---------------------- #
+
+# (user ID, message ID) -> (callback data, time of the tap)
+recent_taps = {}
+
+def is_repeated_tap(uid, query):
+    now = time.monotonic()
+    message_id = query.message.message_id if query.message else query.inline_message_id
+    key = (uid, message_id)
+    previous = recent_taps.get(key)
+    recent_taps[key] = (query.data, now)
+    if len(recent_taps) > 1000:
+        for stale_key in [k for k, (_, at) in recent_taps.items() if now - at > TAP_WINDOW]:
+            del recent_taps[stale_key]
+    return previous is not None and previous[0] == query.data and now - previous[1] < TAP_WINDOW
+
+# Edit the message behind a callback query unless it already shows this content
+async def edit_query_message(query, text, reply_markup=None):
+    message = query.message
+    if message and message.text == text and message.reply_markup == reply_markup:
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
 # ---------------------- Attendance Survey and Summary ---------------------- #
 
-async def send_attendance_request(context: ContextTypes.DEFAULT_TYPE, test: bool = False):
+# Daily jobs are scheduled per tenant with the tenant ID as job data
+async def send_attendance_request(context: ContextTypes.DEFAULT_TYPE, test: bool = False, tenant=None):
     now = datetime.datetime.now(TASHKENT_TZ)
     if not test and now.weekday() >= 5:
         return
-    data = initialize_data()
+    tenant = tenant or context.job.data
+    data = initialize_data(tenant)
     today = now.strftime("%Y-%m-%d")
     if today not in data["daily_attendance"]:
         data["daily_attendance"][today] = {"confirmed": [], "declined": [], "pending": [], "menu": {}}
+    # Build today's menu keyboard before the answers start coming in
+    menu_keyboard(tenant, data, today)
     keyboard = InlineKeyboardMarkup(
         [
             [
@@ -190,128 +789,154 @@ async def send_attendance_request(context: ContextTypes.DEFAULT_TYPE, test: bool
             ]
         ]
     )
+    messages = []
     for uid in data["users"]:
-        try:
-            if uid in data["daily_attendance"][today]["confirmed"] or uid in data["daily_attendance"][today]["declined"]:
-                continue
-            if uid not in data["daily_attendance"][today]["pending"]:
-                data["daily_attendance"][today]["pending"].append(uid)
-            await context.bot.send_message(
-                chat_id=uid,
-                text="Bugun tushlikka qatnashasizmi? (Sizning kunlik narxingiz qo'llaniladi)",
-                reply_markup=keyboard,
-            )
-        except Exception as e:
-            logger.error(f"Failed to send survey to user {uid}: {e}")
-    save_data(data)
+        if uid in data["daily_attendance"][today]["confirmed"] or uid in data["daily_attendance"][today]["declined"]:
+            continue
+        if is_dead_chat(uid):
+            continue
+        if uid not in data["daily_attendance"][today]["pending"]:
+            data["daily_attendance"][today]["pending"].append(uid)
+        messages.append((
+            uid,
+            "Bugun tushlikka qatnashasizmi? (Sizning kunlik narxingiz qo'llaniladi)",
+            keyboard,
+            None if test else f"survey:{tenant}:{today}:{uid}",
+        ))
+    keys = enqueue_messages(messages)
+    save_data(data, tenant)
+    await flush_outbox(context.bot, keys)
 
 async def send_attendance_summary(context: ContextTypes.DEFAULT_TYPE):
     now = datetime.datetime.now(TASHKENT_TZ)
     if now.weekday() >= 5:
         return
-    data = initialize_data()
-    admins = initialize_admins()
+    tenant = context.job.data
+    data = initialize_data(tenant)
+    admins = initialize_admins(tenant)
     today = now.strftime("%Y-%m-%d")
     if today not in data["daily_attendance"]:
         return
     confirmed = data["daily_attendance"][today]["confirmed"]
+    choices = data["daily_attendance"][today].get("menu", {})
+    dishes = date_menu(tenant, data, today)
     summary = f"🍽️ {today} - Tushlik qatnashuvchilari: {len(confirmed)}\n\n"
     if confirmed:
         i = 1
         for uid in confirmed:
             name = data["users"].get(uid, {}).get("name", "Noma'lum")
-            dish = data["daily_attendance"][today].get("menu", {}).get(uid, "N/A")
-            dish_name = MENU_OPTIONS.get(dish, "N/A") if dish != "N/A" else "N/A"
-            summary += f"{i}. {name} - {dish_name}\n"
+            dish = choices.get(uid)
+            summary += f"{i}. {name} - {dishes.get(dish, {}).get('name', 'N/A')}\n"
             i += 1
     else:
         summary += "❌ Bugun tushlik qatnashuvchilar yo'q."
+    charges = {}
     for uid in confirmed:
         if uid in data["users"]:
-            price = data["users"][uid].get("daily_price", 25000)
-            data["users"][uid]["balance"] -= price
+            # The dish price of the date's menu, if set, takes precedence over the daily price
+            price = dishes.get(choices.get(uid), {}).get("price")
+            if price is None:
+                price = daily_price(tenant, data["users"][uid])
+            set_balance(tenant, data, uid, data["users"][uid]["balance"] - price)
             data["kassa"] += price
+            charges[uid] = price
     if today not in data["attendance_history"]:
+        # Charges and the balance snapshot are kept for /hisobot revenue and debt trends
+        balances = [info["balance"] for info in data["users"].values()]
         data["attendance_history"][today] = {
             "confirmed": confirmed.copy(),
             "declined": data["daily_attendance"][today]["declined"].copy(),
-            "menu": data["daily_attendance"][today].get("menu", {}).copy()
+            "menu": data["daily_attendance"][today].get("menu", {}).copy(),
+            "charges": charges,
+            "total_balance": sum(balances),
+            "debtors": sum(1 for bal in balances if bal < 0)
         }
-    save_data(data)
-    for admin_id in admins["admins"]:
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=summary)
-        except Exception as e:
-            logger.error(f"Failed to send summary to admin {admin_id}: {e}")
+        update_forecast(tenant, data, today, data["attendance_history"][today])
+    forget_portions(tenant, today)
+    save_data(data, tenant)
+    keys = enqueue_messages([(admin_id, summary, None, f"summary:{tenant}:{today}:{admin_id}") for admin_id in admins["admins"]])
+    await flush_outbox(context.bot, keys)
+    await send_low_balance_notifications(context)
 
 async def attendance_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    data = initialize_data()
+    # Answer right away; the message edit and the save do not wait for it
+    context.application.create_task(query.answer(), update=update)
     uid = str(query.from_user.id)
+    tenant = tenant_of(uid)
+    if is_repeated_tap(uid, query):
+        return
+    data = initialize_data(tenant)
     callback = query.data
     if callback.startswith("attendance_"):
         action, date = callback.replace("attendance_", "").split("_")
         if date not in data["daily_attendance"]:
             data["daily_attendance"][date] = {"confirmed": [], "declined": [], "pending": [], "menu": {}}
+        sold_out = sold_out_dishes(tenant, data, date)
+        release_portion(tenant, data, date, uid)
         for lst in [data["daily_attendance"][date]["pending"],
                     data["daily_attendance"][date]["confirmed"],
                     data["daily_attendance"][date]["declined"]]:
             if uid in lst:
                 lst.remove(uid)
+        if sold_out_dishes(tenant, data, date) != sold_out:
+            refresh_open_menus_later(context, tenant, date)
         if action == "yes":
-            menu_kb = InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("1. Qovurma Lag'mon", callback_data=f"menu_1_{date}"),
-                     InlineKeyboardButton("2. Teftel Jarkob", callback_data=f"menu_2_{date}")],
-                    [InlineKeyboardButton("3. Mastava", callback_data=f"menu_3_{date}"),
-                     InlineKeyboardButton("4. Sho'rva", callback_data=f"menu_4_{date}")],
-                    [InlineKeyboardButton("5. Sokoro", callback_data=f"menu_5_{date}"),
-                     InlineKeyboardButton("6. Do'lma", callback_data=f"menu_6_{date}")],
-                    [InlineKeyboardButton("7. Teftel sho'rva", callback_data=f"menu_7_{date}"),
-                     InlineKeyboardButton("8. Suyuq lag'mon", callback_data=f"menu_8_{date}")],
-                    [InlineKeyboardButton("9. Osh", callback_data=f"menu_9_{date}"),
-                     InlineKeyboardButton("10. Qovurma Makron", callback_data=f"menu_10_{date}")],
-                    [InlineKeyboardButton("11. Xonim", callback_data=f"menu_11_{date}")]
-                ]
-            )
-            await query.edit_message_text("Iltimos, menyudan tanlang:", reply_markup=menu_kb)
+            menu_kb = menu_keyboard(tenant, data, date)
+            track_open_menu(tenant, date, query.message)
+            await edit_query_message(query, "Iltimos, menyudan tanlang:", reply_markup=menu_kb)
         elif action == "no":
             data["daily_attendance"][date]["declined"].append(uid)
-            await query.edit_message_text("Tushlik uchun javobingiz qayd etildi.")
+            await edit_query_message(query, "Tushlik uchun javobingiz qayd etildi.")
     elif callback.startswith("menu_"):
         parts = callback.split("_")
-        if len(parts) >= 3:
+        # Buttons from before the date's menu was replaced carry the old version
+        if len(parts) >= 3 and (parts[3] if len(parts) > 3 else "0") != menu_tag(data, parts[2]):
+            date = parts[2]
+            track_open_menu(tenant, date, query.message)
+            await edit_query_message(query, "Menyu o'zgardi. Iltimos, qaytadan tanlang:", reply_markup=menu_keyboard(tenant, data, date))
+        elif len(parts) >= 3 and parts[1] in date_menu(tenant, data, parts[2]):
             dish = parts[1]
             date = parts[2]
-            data["daily_attendance"].setdefault(date, {"confirmed": [], "declined": [], "pending": [], "menu": {}})
-            if uid not in data["daily_attendance"][date]["confirmed"]:
-                data["daily_attendance"][date]["confirmed"].append(uid)
-            data["daily_attendance"][date].setdefault("menu", {})[uid] = dish
-            dish_name = MENU_OPTIONS.get(dish, "N/A")
-            await query.edit_message_text(f"Siz tanladingiz: {dish_name}")
+            sold_out = sold_out_dishes(tenant, data, date)
+            if not reserve_portion(tenant, data, date, uid, dish):
+                await edit_query_message(
+                    query,
+                    f"Kechirasiz, {dish_name(tenant, data, date, dish)} tugadi. Iltimos, boshqa taom tanlang:",
+                    reply_markup=menu_keyboard(tenant, data, date),
+                )
+                return
+            untrack_open_menu(tenant, date, query.message)
+            if sold_out_dishes(tenant, data, date) != sold_out:
+                refresh_open_menus_later(context, tenant, date)
+            await edit_query_message(query, f"Siz tanladingiz: {dish_name(tenant, data, date, dish)}")
         else:
-            await query.edit_message_text("Noto'g'ri tanlov.")
-    save_data(data)
+            await edit_query_message(query, "Noto'g'ri tanlov.")
+    save_data_later(tenant)
 
 async def cancel_lunch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     now = datetime.datetime.now(TASHKENT_TZ)
-    if now.hour > 9 or (now.hour == 9 and now.minute >= 59):
+    uid = str(update.effective_user.id)
+    tenant = tenant_of(uid)
+    # Cancellation closes one minute before the tenant's summary hour (9:59 by default)
+    summary_hour = tenant_setting(tenant, "summary_hour", SUMMARY_HOUR)
+    if now.hour >= summary_hour or (now.hour == summary_hour - 1 and now.minute >= 59):
         await update.message.reply_text("Tushlikni bekor qilish muddati o'tib ketdi.")
         return
     today = now.strftime("%Y-%m-%d")
-    data = initialize_data()
+    data = initialize_data(tenant)
     if today not in data["daily_attendance"]:
         await update.message.reply_text("Bugun uchun tushlik ma'lumotlari topilmadi.")
         return
-    uid = str(update.effective_user.id)
+    sold_out = sold_out_dishes(tenant, data, today)
+    release_portion(tenant, data, today, uid)
     if uid in data["daily_attendance"][today]["confirmed"]:
         data["daily_attendance"][today]["confirmed"].remove(uid)
-    if uid in data["daily_attendance"][today].get("menu", {}):
-        del data["daily_attendance"][today]["menu"][uid]
+    if sold_out_dishes(tenant, data, today) != sold_out:
+        refresh_open_menus_later(context, tenant, today)
     if uid not in data["daily_attendance"][today]["declined"]:
         data["daily_attendance"][today]["declined"].append(uid)
-    save_data(data)
+    save_data(data, tenant)
     await update.message.reply_text("Siz tushlikni bekor qildingiz.")
 
 # ---------------------- Admin Functions ---------------------- #
@@ -325,7 +950,8 @@ async def start_balance_modification(update: Update, context: ContextTypes.DEFAU
     else:
         await update.message.reply_text("Noto'g'ri amal.")
         return ConversationHandler.END
-    data = initialize_data()
+    tenant = tenant_of(update.effective_user.id)
+    data = initialize_data(tenant)
     if not data["users"]:
         await update.message.reply_text("Foydalanuvchilar ro'yxati bo'sh.")
         return ConversationHandler.END
@@ -360,7 +986,8 @@ async def balance_mod_enter_amount(update: Update, context: ContextTypes.DEFAULT
     except ValueError:
         await update.message.reply_text("Iltimos, to'g'ri raqam kiriting.")
         return ADMIN_BALANCE_ENTER_AMOUNT
-    data = initialize_data()
+    tenant = tenant_of(update.effective_user.id)
+    data = initialize_data(tenant)
     target_id = context.user_data.get("target_id")
     if not target_id or target_id not in data["users"]:
         await update.message.reply_text("Foydalanuvchi topilmadi.")
@@ -370,9 +997,10 @@ async def balance_mod_enter_amount(update: Update, context: ContextTypes.DEFAULT
         new_balance = old_balance + amount
     else:
         new_balance = old_balance - amount
-    data["users"][target_id]["balance"] = new_balance
-    save_data(data)
+    set_balance(tenant, data, target_id, new_balance)
+    save_data(data, tenant)
     await update.message.reply_text(f"{data['users'][target_id]['name']} ning balansi {old_balance:,} so'mdan {new_balance:,} so'mga o'zgartirildi.")
+    await send_low_balance_notifications(context)
     return ConversationHandler.END
 
 async def cancel_balance_modification(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -381,7 +1009,8 @@ async def cancel_balance_modification(update: Update, context: ContextTypes.DEFA
 
 # Admin Daily Price Adjustment
 async def start_daily_price_modification(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = initialize_data()
+    tenant = tenant_of(update.effective_user.id)
+    data = initialize_data(tenant)
     if not data["users"]:
         await update.message.reply_text("Foydalanuvchilar ro'yxati bo'sh.")
         return ConversationHandler.END
@@ -413,13 +1042,14 @@ async def daily_price_mod_enter_amount(update: Update, context: ContextTypes.DEF
     except ValueError:
         await update.message.reply_text("Iltimos, to'g'ri narx kiriting.")
         return ADMIN_DAILY_PRICE_ENTER_AMOUNT
-    data = initialize_data()
+    tenant = tenant_of(update.effective_user.id)
+    data = initialize_data(tenant)
     target_id = context.user_data.get("price_target_id")
     if not target_id or target_id not in data["users"]:
         await update.message.reply_text("Foydalanuvchi topilmadi.")
         return ConversationHandler.END
     data["users"][target_id]["daily_price"] = price
-    save_data(data)
+    save_data(data, tenant)
     await update.message.reply_text(f"{data['users'][target_id]['name']} ning kunlik narxi {price:,} so'mga o'zgartirildi.")
     return ConversationHandler.END
 
@@ -427,12 +1057,81 @@ async def cancel_daily_price_modification(update: Update, context: ContextTypes.
     await update.message.reply_text("Kunlik narx o'zgarishi bekor qilindi.")
     return ConversationHandler.END
 
+# Admin Menu Setup: /menyu_sozlash YYYY-MM-DD [version]
+async def start_menu_setup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = str(update.effective_user.id)
+    tenant = tenant_of(uid)
+    if not is_admin(uid, initialize_admins(tenant)):
+        await update.message.reply_text("Siz admin emassiz.")
+        return ConversationHandler.END
+    try:
+        date = context.args[0]
+        datetime.datetime.strptime(date, "%Y-%m-%d")
+    except (IndexError, ValueError):
+        await update.message.reply_text("Sanani kiriting. Masalan: /menyu_sozlash 2025-04-17")
+        return ConversationHandler.END
+    data = initialize_data(tenant)
+    if menu_locked(data, date):
+        await update.message.reply_text(f"{date} menyusidan allaqachon tanlov qilingan, uni o'zgartirib bo'lmaydi.")
+        return ConversationHandler.END
+    # Reuse an existing menu version for the date
+    if len(context.args) > 1:
+        version = context.args[1]
+        if version not in data.get("menus", {}).get("versions", {}):
+            await update.message.reply_text("Bunday menyu versiyasi topilmadi.")
+            return ConversationHandler.END
+        data["menus"]["dates"][date] = version
+        save_data(data, tenant)
+        reset_portion_counts(tenant, date)
+        refresh_open_menus_later(context, tenant, date)
+        await update.message.reply_text(f"{date} uchun {version}-versiya menyusi o'rnatildi:\n\n{format_menu(date_menu(tenant, data, date))}")
+        return ConversationHandler.END
+    context.user_data["menu_date"] = date
+    await update.message.reply_text(
+        f"{date} uchun taomlarni kiriting, har birini yangi qatorda:\n"
+        "Nomi; narxi; porsiya soni (narx va porsiya ixtiyoriy)\n\n"
+        "Masalan:\nOsh; 30000; 20\nMastava; 25000\nSho'rva"
+    )
+    return ADMIN_MENU_ENTER_DISHES
+
+async def menu_setup_enter_dishes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        dishes = parse_menu_text(update.message.text)
+    except ValueError:
+        await update.message.reply_text("Menyuni o'qib bo'lmadi. Har bir qator: Nomi; narxi; porsiya soni")
+        return ADMIN_MENU_ENTER_DISHES
+    tenant = tenant_of(update.effective_user.id)
+    data = initialize_data(tenant)
+    date = context.user_data["menu_date"]
+    if menu_locked(data, date):
+        await update.message.reply_text(f"{date} menyusidan allaqachon tanlov qilingan, uni o'zgartirib bo'lmaydi.")
+        return ConversationHandler.END
+    version = save_menu_version(data, dishes)
+    data["menus"]["dates"][date] = version
+    save_data(data, tenant)
+    reset_portion_counts(tenant, date)
+    refresh_open_menus_later(context, tenant, date)
+    await update.message.reply_text(f"{date} uchun menyu saqlandi ({version}-versiya):\n\n{format_menu(dishes)}")
+    return ConversationHandler.END
+
+async def cancel_menu_setup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Menyu sozlash bekor qilindi.")
+    return ConversationHandler.END
+
+# Menu of a date (today by default): /menyu [YYYY-MM-DD]
+async def view_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = tenant_of(update.effective_user.id)
+    data = initialize_data(tenant)
+    date = context.args[0] if context.args else datetime.datetime.now(TASHKENT_TZ).strftime("%Y-%m-%d")
+    await update.message.reply_text(f"🍲 {date} menyusi:\n\n{format_menu(date_menu(tenant, data, date))}")
+
 # ---------------------- Admin and General User Commands ---------------------- #
 
 # General user: Check balance
 async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = initialize_data()
+    tenant = tenant_of(uid)
+    data = initialize_data(tenant)
     if uid not in data["users"]:
         await update.message.reply_text("Siz ro'yxatdan o'tmagansiz. /start buyrug'ini yuboring.")
         return
@@ -443,7 +1142,8 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # General user: Attendance history
 async def check_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    data = initialize_data()
+    tenant = tenant_of(uid)
+    data = initialize_data(tenant)
     if uid not in data["users"]:
         await update.message.reply_text("Siz ro'yxatdan o'tmagansiz. /start buyrug'ini yuboring.")
         return
@@ -458,8 +1158,9 @@ async def check_attendance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Admin: View all registered users
 async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
-    data = initialize_data()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
+    data = initialize_data(tenant)
     if uid not in admins["admins"]:
         await update.message.reply_text("Siz admin emassiz.")
         return
@@ -476,8 +1177,9 @@ async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Admin: View today's attendance
 async def view_attendance_today_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
-    data = initialize_data()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
+    data = initialize_data(tenant)
     if uid not in admins["admins"]:
         await update.message.reply_text("Siz admin emassiz.")
         return
@@ -494,17 +1196,17 @@ async def view_attendance_today_admin(update: Update, context: ContextTypes.DEFA
     for user_id in confirmed:
         if user_id in data["users"]:
             name = data["users"][user_id]["name"]
-            dish = data["daily_attendance"][today].get("menu", {}).get(user_id, "N/A")
-            dish_name = MENU_OPTIONS.get(dish, "N/A") if dish != "N/A" else "N/A"
-            msg += f"{i}. {name} - {dish_name}\n"
+            dish = data["daily_attendance"][today].get("menu", {}).get(user_id)
+            msg += f"{i}. {name} - {dish_name(tenant, data, today, dish)}\n"
             i += 1
     await update.message.reply_text(msg)
 
 # Admin: View all balances
 async def view_all_balances(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
-    data = initialize_data()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
+    data = initialize_data(tenant)
     if uid not in admins["admins"]:
         await update.message.reply_text("Siz admin emassiz.")
         return
@@ -521,8 +1223,9 @@ async def view_all_balances(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Admin: View Kassa (with emoji)
 async def view_kassa(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
-    data = initialize_data()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
+    data = initialize_data(tenant)
     if uid not in admins["admins"]:
         await update.message.reply_text("Siz admin emassiz.")
         return
@@ -533,20 +1236,21 @@ async def view_kassa(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Admin: Reset balances
 async def reset_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
-    data = initialize_data()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
+    data = initialize_data(tenant)
     if uid not in admins["admins"]:
         await update.message.reply_text("Siz admin emassiz.")
         return
     if context.args:
-        target_id = context.args[0]
-        if target_id not in data["users"]:
-            await update.message.reply_text("Bu foydalanuvchi topilmadi.")
+        target_id = await resolve_user_arg(update, context, data, tenant)
+        if target_id is None:
             return
         old_bal = data["users"][target_id]["balance"]
-        data["users"][target_id]["balance"] = 0
-        save_data(data)
+        set_balance(tenant, data, target_id, 0)
+        save_data(data, tenant)
         await update.message.reply_text(f"{data['users'][target_id]['name']} ning balansi {old_bal:,} so'mdan 0 so'mga tushirildi.")
+        await send_low_balance_notifications(context)
     else:
         kb = InlineKeyboardMarkup(
             [[InlineKeyboardButton("Ha ✅", callback_data="reset_all_balances_confirm"),
@@ -558,8 +1262,9 @@ async def balance_reset_callback(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     uid = str(query.from_user.id)
-    admins = initialize_admins()
-    data = initialize_data()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
+    data = initialize_data(tenant)
     if uid not in admins["admins"]:
         await query.edit_message_text("Siz admin emassiz.")
         return
@@ -567,39 +1272,38 @@ async def balance_reset_callback(update: Update, context: ContextTypes.DEFAULT_T
         count = sum(1 for info in data["users"].values() if info["balance"] != 0)
         total = sum(info["balance"] for info in data["users"].values())
         for user_id in data["users"]:
-            data["users"][user_id]["balance"] = 0
-        save_data(data)
+            set_balance(tenant, data, user_id, 0)
+        save_data(data, tenant)
         await query.edit_message_text(f"✅ {count} foydalanuvchining jami {total:,} so'mli balansi nolga tushirildi.")
+        await send_low_balance_notifications(context)
     else:
         await query.edit_message_text("Balanslarni nolga tushirish bekor qilindi.")
 
 # Admin: Make admin
 async def make_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
     if not admins["admins"]:
         admins["admins"].append(uid)
-        save_admins(admins)
+        save_admins(admins, tenant)
         await update.message.reply_text("Siz admin sifatida tayinlandingiz!")
         return
     if uid in admins["admins"]:
         if not context.args:
-            await update.message.reply_text("Yangi admin uchun foydalanuvchi ID kiriting. Masalan: /admin_qoshish 123456789")
+            await update.message.reply_text("Yangi admin uchun foydalanuvchi ID, telefon raqami yoki ismini kiriting. Masalan: /admin_qoshish 123456789")
+            return
+        data = initialize_data(tenant)
+        new_admin = await resolve_user_arg(update, context, data, tenant)
+        if new_admin is None:
             return
-        new_admin = context.args[0]
         if new_admin in admins["admins"]:
             await update.message.reply_text("Bu foydalanuvchi allaqachon admin.")
             return
-        data = initialize_data()
-        if new_admin not in data["users"]:
-            await update.message.reply_text("Bu foydalanuvchi topilmadi.")
-            return
         admins["admins"].append(new_admin)
-        save_admins(admins)
-        try:
-            await context.bot.send_message(chat_id=new_admin, text="Tabriklaymiz! Siz admin sifatida tayinlandingiz.")
-        except Exception as e:
-            logger.error(f"Failed to notify new admin: {e}")
+        save_admins(admins, tenant)
+        key = enqueue_message(new_admin, "Tabriklaymiz! Siz admin sifatida tayinlandingiz.")
+        await flush_outbox(context.bot, [key])
         await show_admin_keyboard(update, context)
         await update.message.reply_text(f"Foydalanuvchi {new_admin} admin sifatida tayinlandi.")
     else:
@@ -608,14 +1312,19 @@ async def make_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Admin: Remove admin
 async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
     if uid not in admins["admins"]:
         await update.message.reply_text("Siz admin emassiz.")
         return
     if not context.args:
-        await update.message.reply_text("Adminni o'chirish uchun foydalanuvchi ID kiriting. Masalan: /admin_ochirish 123456789")
+        await update.message.reply_text("Adminni o'chirish uchun foydalanuvchi ID, telefon raqami yoki ismini kiriting. Masalan: /admin_ochirish 123456789")
         return
     target = context.args[0]
+    if target not in admins["admins"]:
+        target = await resolve_user_arg(update, context, initialize_data(tenant), tenant)
+        if target is None:
+            return
     if target not in admins["admins"]:
         await update.message.reply_text("Bu foydalanuvchi admin emas.")
         return
@@ -623,21 +1332,20 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Siz yagona admin, o'zingizni o'chira olmaysiz.")
         return
     admins["admins"].remove(target)
-    save_admins(admins)
-    try:
-        await context.bot.send_message(chat_id=target, text="Sizning admin huquqlaringiz bekor qilindi.")
-    except Exception as e:
-        logger.error(f"Failed to notify removed admin: {e}")
+    save_admins(admins, tenant)
+    key = enqueue_message(target, "Sizning admin huquqlaringiz bekor qilindi.")
+    await flush_outbox(context.bot, [key])
     await update.message.reply_text(f"Foydalanuvchi {target} admin ro'yxatidan o'chirildi.")
 
 # Admin: Export data
 async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
     if uid not in admins["admins"]:
         await update.message.reply_text("Siz admin emassiz.")
         return
-    data = initialize_data()
+    data = initialize_data(tenant)
     exp = {
         "users": {},
         "total_balance": 0,
@@ -646,7 +1354,7 @@ async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for user_id, info in data["users"].items():
         exp["users"][user_id] = {"name": info["name"], "phone": info["phone"], "balance": info["balance"]}
         exp["total_balance"] += info["balance"]
-    export_file = "export.json"
+    export_file = f"export_{tenant}.json"
     with open(export_file, "w", encoding="utf-8") as f:
         json.dump(exp, f, ensure_ascii=False, indent=4)
     try:
@@ -658,52 +1366,310 @@ async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Failed to send export file: {e}")
         await update.message.reply_text("Ma'lumotlarni eksport qilishda xatolik yuz berdi.")
 
+# ---------------------- Reports ---------------------- #
+
+# Monthly rollups of attendance_history, stored column-wise (one list per metric, one entry
+# per settled day). Closed months never change, so their rollups are cached per tenant.
+report_cache = {}
+
+def build_month_rollup(tenant, data, month):
+    # Registration dates sorted once, so the active users of a day are found with bisect
+    registered = sorted(info.get("registration_date", "")[:10] for info in data["users"].values())
+    rollup = {"days": [], "participants": [], "active": [], "revenue": [],
+              "total_balance": [], "debtors": [], "dishes": {}}
+    for day in sorted(d for d in data["attendance_history"] if d.startswith(month)):
+        rec = data["attendance_history"][day]
+        confirmed = set(rec.get("confirmed", []))
+        charges = rec.get("charges")
+        if charges is None:
+            # Days settled before charges were recorded: use today's prices
+            charges = {uid: daily_price(tenant, data["users"][uid]) for uid in confirmed if uid in data["users"]}
+        rollup["days"].append(day)
+        rollup["participants"].append(len(confirmed))
+        rollup["active"].append(bisect.bisect_right(registered, day))
+        rollup["revenue"].append(sum(charges.values()))
+        rollup["total_balance"].append(rec.get("total_balance"))
+        rollup["debtors"].append(rec.get("debtors"))
+        # Declined users can still have a stale choice in "menu"
+        for uid, dish in rec.get("menu", {}).items():
+            if uid not in confirmed:
+                continue
+            name = dish_name(tenant, data, day, dish)
+            rollup["dishes"][name] = rollup["dishes"].get(name, 0) + 1
+    return rollup
+
+def month_rollup(tenant, data, month):
+    current_month = datetime.datetime.now(TASHKENT_TZ).strftime("%Y-%m")
+    if month >= current_month:
+        return build_month_rollup(tenant, data, month)
+    key = (tenant, month)
+    if key not in report_cache:
+        report_cache[key] = build_month_rollup(tenant, data, month)
+    return report_cache[key]
+
+# Merge monthly rollups into one (e.g. for a yearly report)
+def combine_rollups(rollups):
+    combined = {"days": [], "participants": [], "active": [], "revenue": [],
+                "total_balance": [], "debtors": [], "dishes": {}}
+    for rollup in rollups:
+        for column in ("days", "participants", "active", "revenue", "total_balance", "debtors"):
+            combined[column].extend(rollup[column])
+        for dish_name, count in rollup["dishes"].items():
+            combined["dishes"][dish_name] = combined["dishes"].get(dish_name, 0) + count
+    return combined
+
+def format_report(period, rollup):
+    days = len(rollup["days"])
+    total_participants = sum(rollup["participants"])
+    total_active = sum(rollup["active"])
+    revenue = sum(rollup["revenue"])
+    rate = total_participants / total_active * 100 if total_active else 0
+    msg = f"📈 HISOBOT: {period}\n\n"
+    msg += f"Tushlik kunlari: {days}\n"
+    msg += f"Jami qatnashuvlar: {total_participants}\n"
+    msg += f"O'rtacha kunlik qatnashuvchilar: {total_participants / days if days else 0:.1f}\n"
+    msg += f"Qatnashish darajasi: {rate:.1f}%\n"
+    msg += f"Jami tushum: {revenue:,} so'm\n"
+    msg += f"O'rtacha kunlik tushum: {revenue // days if days else 0:,} so'm\n"
+    snapshots = [(bal, debtors) for bal, debtors in zip(rollup["total_balance"], rollup["debtors"]) if bal is not None]
+    if snapshots:
+        msg += f"Jami balans: {snapshots[0][0]:,} → {snapshots[-1][0]:,} so'm\n"
+        msg += f"Qarzdorlar: {snapshots[0][1]} → {snapshots[-1][1]}\n"
+    if rollup["dishes"]:
+        msg += "\n🍲 Taomlar reytingi:\n"
+        top = sorted(rollup["dishes"].items(), key=lambda x: x[1], reverse=True)
+        most = top[0][1]
+        for dish_name, count in top[:10]:
+            bar = "▇" * max(1, round(count / most * 10))
+            msg += f"{bar} {dish_name}: {count}\n"
+    return msg
+
+def report_csv(rollup):
+    import csv
+    import io
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["date", "participants", "active_users", "attendance_rate", "revenue", "total_balance", "debtors"])
+    for row in zip(rollup["days"], rollup["participants"], rollup["active"], rollup["revenue"],
+                   rollup["total_balance"], rollup["debtors"]):
+        day, participants, active, revenue, total_balance, debtors = row
+        rate = f"{participants / active * 100:.1f}" if active else ""
+        writer.writerow([day, participants, active, rate, revenue,
+                         "" if total_balance is None else total_balance, "" if debtors is None else debtors])
+    return out.getvalue().encode("utf-8")
+
+# Admin: Attendance and spending report, /hisobot [YYYY-MM | YYYY]
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = str(update.effective_user.id)
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
+    if uid not in admins["admins"]:
+        await update.message.reply_text("Siz admin emassiz.")
+        return
+    data = initialize_data(tenant)
+    period = context.args[0] if context.args else datetime.datetime.now(TASHKENT_TZ).strftime("%Y-%m")
+    try:
+        if len(period) == 4:
+            datetime.datetime.strptime(period, "%Y")
+            rollup = combine_rollups(month_rollup(tenant, data, f"{period}-{m:02d}") for m in range(1, 13))
+        else:
+            datetime.datetime.strptime(period, "%Y-%m")
+            rollup = month_rollup(tenant, data, period)
+    except ValueError:
+        await update.message.reply_text("Noto'g'ri davr. Masalan: /hisobot 2025-04 yoki /hisobot 2025")
+        return
+    if not rollup["days"]:
+        await update.message.reply_text(f"{period} uchun ma'lumot topilmadi.")
+        return
+    await update.message.reply_text(format_report(period, rollup))
+    try:
+        await update.message.reply_document(document=report_csv(rollup), filename=f"hisobot_{period}.csv")
+    except Exception as e:
+        logger.error(f"Failed to send report file: {e}")
+
+# ---------------------- Demand Forecast ---------------------- #
+
+WEEKDAY_NAMES = ["Dushanba", "Seshanba", "Chorshanba", "Payshanba", "Juma", "Shanba", "Yakshanba"]
+
+# data["forecast"] keeps one exponentially smoothed model per weekday:
+# {"0": {"days": n, "participants": float, "dishes": {dish name: float}}, ..., "last_day": "YYYY-MM-DD"}
+# Dishes are tracked by name, since the same menu key can mean another dish on another date.
+def observe_forecast_day(tenant, data, forecast, day, rec):
+    model = forecast.setdefault(str(datetime.date.fromisoformat(day).weekday()), {"days": 0, "participants": 0.0, "dishes": {}})
+    model["days"] += 1
+    # Plain average for the first few days, then exponential smoothing
+    alpha = max(FORECAST_ALPHA, 1 / model["days"])
+    confirmed = set(rec.get("confirmed", []))
+    model["participants"] += alpha * (len(confirmed) - model["participants"])
+    counts = {}
+    for uid, dish in rec.get("menu", {}).items():
+        if uid not in confirmed:
+            continue
+        name = dish_name(tenant, data, day, dish)
+        counts[name] = counts.get(name, 0) + 1
+    for dish in set(model["dishes"]) | set(counts):
+        old = model["dishes"].get(dish, 0.0)
+        model["dishes"][dish] = old + alpha * (counts.get(dish, 0) - old)
+    forecast["last_day"] = day
+
+def update_forecast(tenant, data, day, rec):
+    if "forecast" not in data:
+        # First run: seed the model once from the existing history
+        data["forecast"] = {}
+        for past_day in sorted(data["attendance_history"]):
+            if past_day != day:
+                observe_forecast_day(tenant, data, data["forecast"], past_day, data["attendance_history"][past_day])
+    if data["forecast"].get("last_day", "") < day:
+        observe_forecast_day(tenant, data, data["forecast"], day, rec)
+
+def next_lunch_day(now):
+    day = now.date() + datetime.timedelta(days=1)
+    while day.weekday() >= 5:
+        day += datetime.timedelta(days=1)
+    return day
+
+def format_forecast(data, day):
+    model = data.get("forecast", {}).get(str(day.weekday()))
+    if not model:
+        return None
+    msg = f"🔮 {day.isoformat()} ({WEEKDAY_NAMES[day.weekday()]}) uchun taxmin: ~{round(model['participants'])} kishi\n\n"
+    for dish, expected in sorted(model["dishes"].items(), key=lambda x: x[1], reverse=True):
+        if round(expected) > 0:
+            msg += f"{dish}: ~{round(expected)}\n"
+    return msg
+
+# Evening job: send the forecast for the next lunch day to admins
+async def send_demand_forecast(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.datetime.now(TASHKENT_TZ)
+    if now.weekday() >= 5:
+        return
+    tenant = context.job.data
+    data = initialize_data(tenant)
+    msg = format_forecast(data, next_lunch_day(now))
+    if msg is None:
+        return
+    day = now.strftime("%Y-%m-%d")
+    keys = enqueue_messages([(admin_id, msg, None, f"forecast:{tenant}:{day}:{admin_id}") for admin_id in initialize_admins(tenant)["admins"]])
+    await flush_outbox(context.bot, keys)
+
+# Admin: Forecast for the next lunch day
+async def forecast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = str(update.effective_user.id)
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
+    if uid not in admins["admins"]:
+        await update.message.reply_text("Siz admin emassiz.")
+        return
+    data = initialize_data(tenant)
+    msg = format_forecast(data, next_lunch_day(datetime.datetime.now(TASHKENT_TZ)))
+    await update.message.reply_text(msg or "Taxmin uchun hali ma'lumot yetarli emas.")
+
 # ---------------------- Low Balance Notification ---------------------- #
 
+# Users below their low balance threshold, per tenant; built on first use and then kept
+# up to date by set_balance, so nothing has to scan all users
+low_balance_index = {}
+# (tenant, user ID) pairs that crossed below their threshold and still need a notification
+low_balance_queue = []
+
+def balance_threshold(tenant, info):
+    return info.get("low_balance_threshold", tenant_setting(tenant, "low_balance_threshold", LOW_BALANCE_THRESHOLD))
+
+def low_balance_users(tenant, data):
+    if tenant not in low_balance_index:
+        low_balance_index[tenant] = {uid for uid, info in data["users"].items()
+                                     if info.get("balance", 0) < balance_threshold(tenant, info)}
+    return low_balance_index[tenant]
+
+# Update the low balance index for a user; queue a notification when they cross the threshold
+def check_low_balance(tenant, data, uid, notify=True):
+    below = low_balance_users(tenant, data)
+    info = data["users"][uid]
+    if info.get("balance", 0) < balance_threshold(tenant, info):
+        if uid not in below:
+            below.add(uid)
+            if notify:
+                low_balance_queue.append((tenant, uid))
+    else:
+        below.discard(uid)
+
+# All balance changes go through here so the low balance index stays in sync
+def set_balance(tenant, data, uid, new_balance):
+    low_balance_users(tenant, data)
+    data["users"][uid]["balance"] = new_balance
+    check_low_balance(tenant, data, uid)
+
 async def send_low_balance_notifications(context: ContextTypes.DEFAULT_TYPE):
-    data = initialize_data()
+    if not low_balance_queue:
+        return
     today = datetime.datetime.now(TASHKENT_TZ).strftime("%Y-%m-%d")
-    for user_id, info in data["users"].items():
-        if info["balance"] < 100000:
-            last_notif = info.get("last_balance_notification", "")
-            if last_notif == today:
-                continue
-            try:
-                msg = (f"Hurmatli foydalanuvchi, sizning balansingiz {info['balance']:,} so'mga yetdi.\n"
-                       "Iltimos, balansingizni to'ldiring. Rahmat!")
-                await context.bot.send_message(chat_id=user_id, text=msg)
-                data["users"][user_id]["last_balance_notification"] = today
-            except Exception as e:
-                logger.error(f"Failed to send low balance notification to user {user_id}: {e}")
-    save_data(data)
+    messages = []
+    while low_balance_queue:
+        tenant, user_id = low_balance_queue.pop(0)
+        info = initialize_data(tenant)["users"].get(user_id)
+        # Skip users who topped up before the notification went out
+        if info is None or user_id not in low_balance_index.get(tenant, ()):
+            continue
+        msg = (f"Hurmatli foydalanuvchi, sizning balansingiz {info['balance']:,} so'mga yetdi.\n"
+               "Iltimos, balansingizni to'ldiring. Rahmat!")
+        messages.append((user_id, msg, None, f"low_balance:{tenant}:{today}:{user_id}"))
+    keys = enqueue_messages(messages)
+    await flush_outbox(context.bot, keys)
+
+# Set the low balance threshold: /chegara <amount> for yourself, admins may add [id|telefon|ism]
+async def set_low_balance_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = str(update.effective_user.id)
+    tenant = tenant_of(uid)
+    data = initialize_data(tenant)
+    if uid not in data["users"]:
+        await update.message.reply_text("Siz ro'yxatdan o'tmagansiz. /start buyrug'ini yuboring.")
+        return
+    try:
+        threshold = int(context.args[0])
+        if threshold < 0:
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text("Iltimos, summani kiriting. Masalan: /chegara 50000")
+        return
+    target_id = uid
+    if len(context.args) > 1:
+        if not is_admin(uid, initialize_admins(tenant)):
+            await update.message.reply_text("Siz admin emassiz.")
+            return
+        target_id = await resolve_user_arg(update, context, data, tenant, " ".join(context.args[1:]))
+        if target_id is None:
+            return
+    data["users"][target_id]["low_balance_threshold"] = threshold
+    check_low_balance(tenant, data, target_id)
+    save_data(data, tenant)
+    await update.message.reply_text(f"{data['users'][target_id]['name']} uchun balans chegarasi {threshold:,} so'm qilib belgilandi.")
+    await send_low_balance_notifications(context)
 
 # Legacy reminder function (optional)
 async def remind_debtors(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
     if uid not in admins["admins"]:
         await update.message.reply_text("Siz admin emassiz.")
         return
-    data = initialize_data()
-    debtors = [(uid, info) for uid, info in data["users"].items() if info["balance"] < 100000]
+    data = initialize_data(tenant)
+    debtors = [(user_id, data["users"][user_id]) for user_id in sorted(low_balance_users(tenant, data))]
     if not debtors:
         await update.message.reply_text("Hech kimda balans muammosi yo'q.")
         return
-    sent, failed = 0, 0
-    for user_id, info in debtors:
-        try:
-            await context.bot.send_message(chat_id=user_id, text=f"Sizning balansingiz: {info['balance']:,} so'm.")
-            sent += 1
-        except Exception as e:
-            logger.error(f"Failed to send reminder to user {user_id}: {e}")
-            failed += 1
+    keys = enqueue_messages([(user_id, f"Sizning balansingiz: {info['balance']:,} so'm.", None, None) for user_id, info in debtors])
+    delivered = await flush_outbox(context.bot, keys)
+    sent = sum(1 for key in keys if key in delivered)
+    failed = len(keys) - sent
     await update.message.reply_text(f"✅ {sent} ta foydalanuvchiga eslatma yuborildi.\n❌ {failed} ta yuborilmadi.")
 
 # ---------------------- Help Command ---------------------- #
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    admins = initialize_admins()
+    tenant = tenant_of(uid)
+    admins = initialize_admins(tenant)
     msg = "🍽️ MY TUSHLIK BOT BUYRUQLARI:\n\n"
     msg += "👤 FOYDALANUVCHI UCHUN:\n"
     msg += "/start - Botni ishga tushirish va ro'yxatdan o'tish\n"
@@ -711,19 +1677,25 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg += "/qatnashish - Qatnashishlaringiz tarixi\n"
     msg += "/❌ Tushlikni bekor qilish - (agar 9:59gacha)\n"
     msg += "/ism_ozgartirish - Ismingizni o'zgartirish\n"
+    msg += "/menyu [sana] - Kun menyusi\n"
+    msg += "/chegara [summa] - Balans shu summadan kam bo'lsa ogohlantirish\n"
     msg += "/yordam - Yordam\n\n"
     if is_admin(uid, admins):
         msg += "👑 ADMINISTRATOR UCHUN:\n"
-        msg += "/admin_qoshish [id] - Yangi admin qo'shish\n"
-        msg += "/admin_ochirish [id] - Adminni o'chirish\n"
+        msg += "/admin_qoshish [id|telefon|ism] - Yangi admin qo'shish\n"
+        msg += "/admin_ochirish [id|telefon|ism] - Adminni o'chirish\n"
         msg += "Interaktiv tugmalar:\n"
         msg += " • 💵 Balans qo'shish / 💸 Balans kamaytirish\n"
         msg += " • 📝 Kunlik narx - Foydalanuvchining kunlik tushlik narxini sozlash\n"
-        msg += "/balans_nol - Barcha balanslarni nolga tushirish\n"
+        msg += "/menyu_sozlash [sana] [versiya] - Kun menyusi, taom narxlari va porsiyalarini sozlash (taom narxi kunlik narxdan ustun)\n"
+        msg += "/balans_nol [id|telefon|ism] - Balansni (yoki barcha balanslarni) nolga tushirish\n"
         msg += "/balanslar - Barcha foydalanuvchilarning balanslari\n"
         msg += "/bugun - Bugungi tushlik qatnashuvchilari\n"
         msg += "/eksport - Ma'lumotlarni eksport qilish\n"
+        msg += "/hisobot [YYYY-MM|YYYY] - Qatnashuv va tushum hisoboti (CSV bilan)\n"
+        msg += "/prognoz - Keyingi tushlik kuni uchun taxminiy qatnashuvchilar va taomlar\n"
         msg += "/eslatma - Kam balansli foydalanuvchilarga eslatma yuborish\n"
+        msg += "/chegara [summa] [id|telefon|ism] - Foydalanuvchining balans chegarasini sozlash\n"
         msg += "/kassa - 💰 Kassa balansini ko'rish\n"
         msg += "/test_survey - (Test) Tushlik so'rovini yuborish\n"
     await update.message.reply_text(msg)
@@ -746,7 +1718,7 @@ async def show_admin_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
 async def show_regular_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    admin_button = "👑 Admin panel" if is_admin(str(update.effective_user.id), initialize_admins()) else "❓ Yordam"
+    admin_button = "👑 Admin panel" if is_admin(update.effective_user.id, initialize_admins(tenant_of(update.effective_user.id))) else "❓ Yordam"
     await update.message.reply_text(
         "Asosiy menyu:",
         reply_markup=ReplyKeyboardMarkup(
@@ -759,7 +1731,7 @@ async def show_regular_keyboard(update: Update, context: ContextTypes.DEFAULT_TY
     )
 
 async def admin_panel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if is_admin(str(update.effective_user.id), initialize_admins()):
+    if is_admin(update.effective_user.id, initialize_admins(tenant_of(update.effective_user.id))):
         await show_admin_keyboard(update, context)
     else:
         await update.message.reply_text("Siz admin emassiz.")
@@ -767,19 +1739,84 @@ async def admin_panel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 # ---------------------- Testing Command ---------------------- #
 
 async def test_survey(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await send_attendance_request(context, test=True)
+    await send_attendance_request(context, test=True, tenant=tenant_of(update.effective_user.id))
     await update.message.reply_text("Test survey yuborildi!")
 
-# ---------------------- Scheduled Low Balance Notification ---------------------- #
-
-async def scheduled_low_balance_notification(context: ContextTypes.DEFAULT_TYPE):
-    await send_low_balance_notifications(context)
+# ---------------------- Handler Table ---------------------- #
+
+# Reply keyboard buttons: (regex pattern, handler)
+MESSAGE_ROUTES = [
+    ("^💸 Balansim$", check_balance),
+    ("^📊 Qatnashishlarim$", check_attendance),
+    ("^❌ Tushlikni bekor qilish$", cancel_lunch),
+    ("^❓ Yordam$", help_command),
+    ("^👑 Admin panel$", admin_panel_handler),
+    ("^👥 Foydalanuvchilar$", view_users),
+    ("^💰 Barcha balanslar$", view_all_balances),
+    ("^📊 Bugungi qatnashuv$", view_attendance_today_admin),
+    ("^🔄 Balanslarni nollash$", reset_balance),
+    ("^💰 Kassa$", view_kassa),
+    ("^⬅️ Asosiy menyu$", show_regular_keyboard),
+]
+
+# Slash commands: (command, handler)
+COMMAND_ROUTES = [
+    ("admin", show_admin_keyboard),
+    ("balans", check_balance),
+    ("qatnashish", check_attendance),
+    ("menyu", view_menu),
+    ("admin_qoshish", make_admin),
+    ("admin_ochirish", remove_admin),
+    ("balans_nol", reset_balance),
+    ("balanslar", view_all_balances),
+    ("bugun", view_attendance_today_admin),
+    ("eksport", export_data),
+    ("hisobot", report_command),
+    ("prognoz", forecast_command),
+    ("eslatma", remind_debtors),
+    ("chegara", set_low_balance_threshold),
+    ("kassa", view_kassa),
+    ("test_survey", test_survey),
+]
+
+# Inline button callbacks: (callback data pattern, handler)
+CALLBACK_ROUTES = [
+    ("^(attendance_|menu_)", attendance_callback),
+    ("^reset_all_balances_", balance_reset_callback),
+]
+
+# Daily jobs: (job, tenant setting for the hour, default hour in Tashkent time)
+DAILY_JOBS = [
+    (send_attendance_request, "survey_hour", SURVEY_HOUR),
+    (send_attendance_summary, "summary_hour", SUMMARY_HOUR),
+    (send_demand_forecast, "forecast_hour", FORECAST_HOUR),
+]
 
 # ---------------------- Main Function ---------------------- #
 
+def mark_startup_phase(phase):
+    STARTUP_PHASES.append((phase, time.perf_counter()))
+
+def startup_report():
+    parts = []
+    for (_, prev), (phase, at) in zip(STARTUP_PHASES, STARTUP_PHASES[1:]):
+        parts.append(f"{phase}={(at - prev) * 1000:.0f}ms")
+    total = (STARTUP_PHASES[-1][1] - STARTUP_PHASES[0][1]) * 1000
+    return f"{', '.join(parts)}, total={total:.0f}ms"
+
+async def on_startup_ready(application: Application):
+    mark_startup_phase("connect")
+    logger.info(f"Startup timings: {startup_report()}")
+
+async def on_shutdown(application: Application):
+    flush_pending_saves()
+
 def main():
-    token = "7827859748:AAEDW4Dlmv49bGwps2-OyPcLS_ysEn4TmPU"
-    application = Application.builder().token(token).build()
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN is not set. Add it to .env or the environment.")
+        return
+    application = Application.builder().token(BOT_TOKEN).post_init(on_startup_ready).post_shutdown(on_shutdown).build()
+    mark_startup_phase("build")
 
     # Registration conversation
     reg_conv = ConversationHandler(
@@ -825,55 +1862,38 @@ def main():
     )
     application.add_handler(daily_price_conv)
 
-    # Handlers for general user options
-    application.add_handler(MessageHandler(filters.Regex("^💸 Balansim$"), check_balance))
-    application.add_handler(MessageHandler(filters.Regex("^📊 Qatnashishlarim$"), check_attendance))
-    application.add_handler(MessageHandler(filters.Regex("^❌ Tushlikni bekor qilish$"), cancel_lunch))
-    application.add_handler(MessageHandler(filters.Regex("^❓ Yordam$"), help_command))
-    application.add_handler(MessageHandler(filters.Regex("^👑 Admin panel$"), admin_panel_handler))
-    application.add_handler(MessageHandler(filters.Regex("^👥 Foydalanuvchilar$"), view_users))
-    application.add_handler(MessageHandler(filters.Regex("^💰 Barcha balanslar$"), view_all_balances))
-    application.add_handler(MessageHandler(filters.Regex("^📊 Bugungi qatnashuv$"), view_attendance_today_admin))
-    application.add_handler(MessageHandler(filters.Regex("^🔄 Balanslarni nollash$"), reset_balance))
-    application.add_handler(MessageHandler(filters.Regex("^💰 Kassa$"), view_kassa))
-    application.add_handler(MessageHandler(filters.Regex("^⬅️ Asosiy menyu$"), show_regular_keyboard))
-
-    # Command handlers
-    application.add_handler(CommandHandler("admin", show_admin_keyboard))
-    application.add_handler(CommandHandler("balans", check_balance))
-    application.add_handler(CommandHandler("qatnashish", check_attendance))
-    application.add_handler(CommandHandler("admin_qoshish", make_admin))
-    application.add_handler(CommandHandler("admin_ochirish", remove_admin))
-    application.add_handler(CommandHandler("balans_nol", reset_balance))
-    application.add_handler(CommandHandler("balanslar", view_all_balances))
-    application.add_handler(CommandHandler("bugun", view_attendance_today_admin))
-    application.add_handler(CommandHandler("eksport", export_data))
-    application.add_handler(CommandHandler("eslatma", remind_debtors))
-    application.add_handler(CommandHandler("kassa", view_kassa))
-    application.add_handler(CommandHandler("test_survey", test_survey))
-
-    # Callback query handlers for attendance survey and balance reset
-    application.add_handler(CallbackQueryHandler(attendance_callback, pattern="^(attendance_|menu_)"))
-    application.add_handler(CallbackQueryHandler(balance_reset_callback, pattern="^reset_all_balances_"))
-
-    # Schedule daily jobs:
-    now = datetime.datetime.now(TASHKENT_TZ)
-    target_morning = now.replace(hour=7, minute=0, second=0, microsecond=0)
-    if now >= target_morning:
-        target_morning += datetime.timedelta(days=1)
-    application.job_queue.run_once(send_attendance_request, (target_morning - now).total_seconds())
-    application.job_queue.run_daily(send_attendance_request, time=datetime.time(hour=7, minute=0, second=0, tzinfo=TASHKENT_TZ))
-    target_summary = now.replace(hour=10, minute=0, second=0, microsecond=0)
-    if now >= target_summary:
-        target_summary += datetime.timedelta(days=1)
-    application.job_queue.run_once(send_attendance_summary, (target_summary - now).total_seconds())
-    application.job_queue.run_daily(send_attendance_summary, time=datetime.time(hour=10, minute=0, second=0, tzinfo=TASHKENT_TZ))
-    target_notification = now.replace(hour=12, minute=0, second=0, microsecond=0)
-    if now >= target_notification:
-        target_notification += datetime.timedelta(days=1)
-    application.job_queue.run_once(scheduled_low_balance_notification, (target_notification - now).total_seconds())
-    application.job_queue.run_daily(scheduled_low_balance_notification, time=datetime.time(hour=12, minute=0, second=0, tzinfo=TASHKENT_TZ))
-    
+    # Admin Menu Setup conversation
+    menu_conv = ConversationHandler(
+        entry_points=[CommandHandler("menyu_sozlash", start_menu_setup)],
+        states={
+            ADMIN_MENU_ENTER_DISHES: [MessageHandler(filters.TEXT & ~filters.COMMAND, menu_setup_enter_dishes)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel_menu_setup)]
+    )
+    application.add_handler(menu_conv)
+
+    for pattern, callback in MESSAGE_ROUTES:
+        application.add_handler(MessageHandler(filters.Regex(pattern), callback))
+    for command, callback in COMMAND_ROUTES:
+        application.add_handler(CommandHandler(command, callback))
+    for pattern, callback in CALLBACK_ROUTES:
+        application.add_handler(CallbackQueryHandler(callback, pattern=pattern))
+    mark_startup_phase("handlers")
+
+    # Each tenant gets its own daily jobs at its own hours.
+    # run_daily fires at the next occurrence of the given time, so no extra run_once is needed
+    for tenant in initialize_tenants()["tenants"]:
+        for job, setting, hour in DAILY_JOBS:
+            hour = tenant_setting(tenant, setting, hour)
+            application.job_queue.run_daily(
+                job,
+                time=datetime.time(hour=hour, minute=0, second=0, tzinfo=TASHKENT_TZ),
+                data=tenant,
+                name=f"{job.__name__}:{tenant}",
+            )
+    application.job_queue.run_repeating(process_outbox, interval=OUTBOX_INTERVAL, first=OUTBOX_INTERVAL, name="process_outbox")
+    mark_startup_phase("jobs")
+
     application.run_polling()
 
 if __name__ == "__main__":